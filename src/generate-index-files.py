@@ -11,10 +11,10 @@ Uses Jinja2 for HTML templating and Bootstrap for responsive, attractive styling
 
 import os
 import sqlite3
+import hashlib
 import argparse
 from pathlib import Path
-import html
-from jinja2 import Environment, FileSystemLoader, Template
+from jinja2 import Environment, DictLoader, FileSystemBytecodeCache, select_autoescape
 
 
 # Jinja2 template for index.html with Bootstrap styling
@@ -170,6 +170,109 @@ INDEX_TEMPLATE = """<!DOCTYPE html>
 </html>
 """
 
+# Compile the template once, at import. The bytecode cache lets later runs skip
+# compilation too (from_string() bypasses the cache, hence the DictLoader), and
+# autoescaping HTML templates escapes every value with MarkupSafe, so the page
+# data is passed in raw. A custom --template is registered as custom.html, so it
+# is cached and escaped the same way.
+_ENV = Environment(
+    loader=DictLoader({'index.html': INDEX_TEMPLATE}),
+    bytecode_cache=FileSystemBytecodeCache(),
+    auto_reload=False,
+    trim_blocks=True,
+    lstrip_blocks=True,
+    autoescape=select_autoescape(['html'])
+)
+_TEMPLATE = _ENV.get_template('index.html')
+
+PDF_SUFFIXES = ('.pdf', '.PDF', '.Pdf')
+
+# Pages are rendered with this in place of the date, and the digest of that rendering
+# is kept in a comment at the end of index.html, so an unchanged listing isn't rewritten
+GENERATION_DATE_PLACEHOLDER = '@@generation_date@@'
+DIGEST_COMMENT = '\n<!-- content digest: {} -->\n'
+
+# Per-connection settings only; a reader shouldn't change the database's journal mode.
+# (The Librarian uses WAL while it writes and returns the file to a rollback journal.)
+SQLITE_PRAGMAS = """
+PRAGMA cache_size=-65536;
+PRAGMA temp_store=MEMORY;
+PRAGMA mmap_size=268435456;
+"""
+
+
+def is_pdf_name(name):
+    """
+    Return True if name has a .pdf extension, in any case.
+
+    The usual spellings are matched by str.endswith without building a lowercased
+    copy of the name; anything else falls back to lower() on the last 4 characters.
+    """
+    return name.endswith(PDF_SUFFIXES) or name[-4:].lower() == '.pdf'
+
+
+def scan_tree(directory):
+    """
+    Yield (dirpath, subdirectory entries, file entries) for each directory, top-down like os.walk.
+
+    The os.DirEntry objects carry the type information from the directory listing,
+    so callers can use them without another stat per file.
+    """
+    try:
+        with os.scandir(directory) as it:
+            entries = list(it)
+    except OSError:
+        return
+
+    dir_entries = []
+    file_entries = []
+    for entry in entries:
+        if entry.is_dir():
+            dir_entries.append(entry)
+        else:
+            file_entries.append(entry)
+
+    yield directory, dir_entries, file_entries
+
+    for entry in dir_entries:
+        # Like os.walk, list symlinked directories but don't descend into them
+        if not entry.is_symlink():
+            yield from scan_tree(entry.path)
+
+
+def all_metadata_by_directory(cursor):
+    """
+    Read every row at once, grouped by directory.
+
+    Fallback for databases written before the Librarian added the dir column.
+    Returns a dict mapping each directory to a dict of filename to (title, authors).
+    """
+    by_directory = {}
+    cursor.execute("SELECT path, title, authors FROM pdf_info")
+    for path, title, authors in cursor:
+        directory, filename = os.path.split(path)
+        by_directory.setdefault(directory, {})[filename] = (title or "No Title", authors or "Unknown")
+    return by_directory
+
+
+def directory_metadata(cursor, original_dir, dirpath):
+    """
+    Fetch title and authors for the PDFs stored under one directory.
+
+    original_dir is where the directory lived on the machine that built the
+    database; dirpath is its local path, which rows outside the original prefix
+    were stored under. Returns a dict mapping filename to a (title, authors)
+    tuple. Only this directory's rows are read, using the indexed dir column.
+    """
+    cursor.execute(
+        "SELECT path, title, authors FROM pdf_info WHERE dir IN (?, ?)",
+        (original_dir, dirpath)
+    )
+    return {
+        os.path.basename(path): (title or "No Title", authors or "Unknown")
+        for path, title, authors in cursor
+    }
+
 
 def create_index_files(root_dir, db_path, server_url_prefix, original_path_prefix=None):
     """
@@ -181,47 +284,39 @@ def create_index_files(root_dir, db_path, server_url_prefix, original_path_prefi
         server_url_prefix: URL prefix for accessing files (e.g., 'http://raspberrypi.local/')
         original_path_prefix: Prefix in the database paths that should be replaced with root_dir
     """
-    # Connect to the SQLite database
-    conn = sqlite3.connect(db_path)
+    root_dir = os.path.abspath(root_dir)
+
+    # Connect to the SQLite database, read-only: upgrading the schema is the Librarian's job
+    conn = sqlite3.connect(Path(db_path).absolute().as_uri() + '?mode=ro', uri=True)
+    conn.executescript(SQLITE_PRAGMAS)
     cursor = conn.cursor()
+
+    # Query each directory through the indexed dir column if the database has one
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(pdf_info)")}
+    by_directory = None if 'dir' in columns else all_metadata_by_directory(cursor)
     
-    # Get all PDF entries from the database
-    cursor.execute("SELECT path, title, authors FROM pdf_info")
-    pdf_entries = cursor.fetchall()
-    
-    # Create a dictionary to store metadata by path
-    pdf_metadata = {}
-    for path, title, authors in pdf_entries:
-        if original_path_prefix and path.startswith(original_path_prefix):
-            # Convert original path to local path
-            relative_path = path[len(original_path_prefix):].lstrip('/')
-            local_path = os.path.join(root_dir, relative_path)
-            pdf_metadata[local_path] = {
-                'title': title if title else "No Title",
-                'authors': authors if authors else "Unknown"
-            }
-        else:
-            # If no prefix mapping, use path as is
-            pdf_metadata[path] = {
-                'title': title if title else "No Title",
-                'authors': authors if authors else "Unknown"
-            }
-    
-    # Close the database connection
-    conn.close()
-    
-    # Create Jinja2 template
-    template = Template(INDEX_TEMPLATE)
+    # Decide on the prefix mapping once: every dirpath starts with root_dir, so the
+    # original location is the original root plus the rest of dirpath
+    original_root = os.path.normpath(original_path_prefix) if original_path_prefix else None
+    root_len = len(root_dir.rstrip(os.sep))
     
     # Walk the directory tree and create index files
-    for dirpath, dirnames, filenames in os.walk(root_dir):
+    for dirpath, dir_entries, file_entries in scan_tree(root_dir):
+        original_dir = original_root + dirpath[root_len:] if original_root else dirpath
+        if by_directory is None:
+            pdf_metadata = directory_metadata(cursor, original_dir, dirpath)
+        else:
+            pdf_metadata = {**by_directory.get(dirpath, {}), **by_directory.get(original_dir, {})}
         create_index_for_directory(
-            dirpath, dirnames, filenames,
-            pdf_metadata, root_dir, server_url_prefix, template
+            dirpath, dir_entries, file_entries,
+            pdf_metadata, root_dir, server_url_prefix
         )
 
+    # Close the database connection
+    conn.close()
+
 
-def create_index_for_directory(dirpath, dirnames, filenames, pdf_metadata, root_dir, server_url_prefix, template):
+def create_index_for_directory(dirpath, dir_entries, file_entries, pdf_metadata, root_dir, server_url_prefix):
     """Create an index.html file for a single directory using Jinja2 template with Bootstrap styling."""
     import datetime
     
@@ -236,10 +331,11 @@ def create_index_for_directory(dirpath, dirnames, filenames, pdf_metadata, root_
     parent_url = f'{server_url_prefix}/{parent_path}' if parent_path else None
     
     # Filter for PDF files and prepare data for template
+    pdf_names = [e.name for e in file_entries if is_pdf_name(e.name)]
+    pdf_names.sort()
     pdf_files = []
-    for filename in sorted([f for f in filenames if f.lower().endswith('.pdf')]):
-        pdf_path = os.path.join(dirpath, filename)
-        metadata = pdf_metadata.get(pdf_path, {'title': 'No Title', 'authors': 'Unknown'})
+    for filename in pdf_names:
+        title, authors = pdf_metadata.get(filename, ("No Title", "Unknown"))
         
         # Create file URL
         if is_root:
@@ -248,15 +344,15 @@ def create_index_for_directory(dirpath, dirnames, filenames, pdf_metadata, root_
             file_url = f'{server_url_prefix}/{rel_path}/{filename}'
         
         pdf_files.append({
-            'filename': html.escape(filename),
+            'filename': filename,
             'url': file_url,
-            'title': html.escape(metadata['title']),
-            'authors': html.escape(metadata['authors'])
+            'title': title,
+            'authors': authors
         })
     
     # Prepare directory data
     directories = []
-    for dirname in sorted(dirnames):
+    for dirname in sorted(e.name for e in dir_entries):
         # Skip hidden directories
         if dirname.startswith('.'):
             continue
@@ -268,31 +364,50 @@ def create_index_for_directory(dirpath, dirnames, filenames, pdf_metadata, root_
             subdir_url = f'{server_url_prefix}/{rel_path}/{dirname}'
         
         directories.append({
-            'name': html.escape(dirname),
+            'name': dirname,
             'url': subdir_url
         })
     
-    # Get current date/time for footer
-    generation_date = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    
-    # Render the template
-    html_content = template.render(
+    # Render the template, leaving the footer date as a placeholder for now
+    html_content = _TEMPLATE.render(
         is_root=is_root,
         directory_name=directory_name,
         server_url=server_url_prefix,
         parent_url=parent_url,
         directories=directories,
         pdf_files=pdf_files,
-        generation_date=generation_date
+        generation_date=GENERATION_DATE_PLACEHOLDER
     )
     
+    # Skip the write if the existing file was generated from the same content
+    digest = hashlib.blake2b(html_content.encode('utf-8'), digest_size=16).hexdigest()
+    trailer = DIGEST_COMMENT.format(digest).encode('ascii')
+    if file_ends_with(index_path, trailer):
+        print(f"index.html in {dirpath} is up to date")
+        return
+    
+    # Get current date/time for footer
+    generation_date = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    html_content = html_content.replace(GENERATION_DATE_PLACEHOLDER, generation_date)
+    
     # Write the index.html file
-    with open(index_path, 'w', encoding='utf-8') as f:
-        f.write(html_content)
+    with open(index_path, 'wb') as f:
+        f.write(html_content.encode('utf-8'))
+        f.write(trailer)
     
     print(f"Created index.html in {dirpath}")
 
 
+def file_ends_with(path, tail):
+    """Return True if the file at path ends with the bytes tail, False if it is missing or shorter."""
+    try:
+        with open(path, 'rb') as f:
+            f.seek(-len(tail), os.SEEK_END)
+            return f.read() == tail
+    except OSError:
+        return False
+
+
 def main():
     parser = argparse.ArgumentParser(description='Generate index.html files for a PDF directory tree')
     parser.add_argument('--root', required=True, help='Root directory of the PDF collection')
@@ -304,10 +419,11 @@ def main():
     args = parser.parse_args()
     
     # If a custom template file is provided, use it instead of the default
-    global INDEX_TEMPLATE
+    global _TEMPLATE
     if args.template:
         with open(args.template, 'r', encoding='utf-8') as f:
-            INDEX_TEMPLATE = f.read()
+            _ENV.loader.mapping['custom.html'] = f.read()
+        _TEMPLATE = _ENV.get_template('custom.html')
     
     create_index_files(
         args.root, 
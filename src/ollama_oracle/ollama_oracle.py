@@ -1,14 +1,24 @@
 #!/usr/bin/env python
 # coding: utf-8
 import os
+import sys
 import time
+import logging
+import logging.handlers
 import sqlite3
-from pdfminer.high_level import extract_text
+import asyncio
+import queue
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor
+from contextlib import closing
+import httpx
+import pypdfium2 as pdfium
 from pydantic import BaseModel
-from ollama import Client
+from ollama import AsyncClient
 from dotenv import load_dotenv
 
 load_dotenv()
+logger = logging.getLogger(__name__)
 TEMPLATE = "Can you tell me the title and author from this start of an academic paper?{text}"
 
 
@@ -25,96 +35,273 @@ PAPER_FORMAT = Paper.model_json_schema()
 
 DIRECTORY = os.getenv("DIRECTORY", "../data/pdfs")
 OLLAMA_URL = os.getenv("OLLAMA_URL", "http://localhost:11434")
-OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "qwen2.5")
+OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "qwen2.5:1.5b-instruct-q4_K_M")
 OLLAMA_TIMEOUT = int(os.getenv("OLLAMA_TIMEOUT", "120"))  # increased default timeout to 120 seconds
+MAX_TEXT_LINES = int(os.getenv("MAX_TEXT_LINES", "30"))  # non-empty lines of the first page sent to the model
+MAX_TEXT_LENGTH = int(os.getenv("MAX_TEXT_LENGTH", "1500"))  # ...capped at this many characters
+# Longest reply, in tokens: room for papers with long author lists
+OLLAMA_NUM_PREDICT = int(os.getenv("OLLAMA_NUM_PREDICT", "512"))
+# A title and author list is a short answer, so keep the context and the reply small
+OLLAMA_OPTIONS = {"num_predict": OLLAMA_NUM_PREDICT, "temperature": 0, "num_ctx": 2048}
+OLLAMA_CONCURRENCY = int(os.getenv("OLLAMA_CONCURRENCY", "4"))  # number of papers in flight at once
+BATCH_SIZE = int(os.getenv("BATCH_SIZE", "50"))  # rows written per database transaction; lost if the run dies
+
+# Per-connection settings: 64 MiB page cache, temp tables in memory, 256 MiB mmap
+SQLITE_PRAGMAS = """
+PRAGMA cache_size=-65536;
+PRAGMA temp_store=MEMORY;
+PRAGMA mmap_size=268435456;
+"""
+# Only while a run is writing: WAL lets readers (such as generate-index-files.py) carry on
+# meanwhile. The file goes back to a rollback journal afterwards, because a WAL database
+# can't be read without write access to its directory (for the -wal and -shm files).
+RUN_PRAGMAS = """
+PRAGMA journal_mode=WAL;
+PRAGMA synchronous=NORMAL;
+"""
+
+def first_page_text(path: str) -> str:
+    """Extract the text of the first page of a PDF, using the C-backed pdfium library."""
+    # Close every handle even if extraction fails, as this runs in long-lived pool workers
+    with closing(pdfium.PdfDocument(path)) as pdf:
+        if len(pdf) == 0:
+            return ""
+        with closing(pdf[0]) as page, closing(page.get_textpage()) as textpage:
+            return textpage.get_text_bounded()
+
 
 class Librarian:
 
-    def __init__(self):
-        self.connection = sqlite3.connect('../pdf_files.db')
+    def __init__(self, concurrency: int = OLLAMA_CONCURRENCY):
+        self.connection = self._connect()
         self._create_table()
-        self.client = Client(host=OLLAMA_URL, timeout=OLLAMA_TIMEOUT)
+        # Built once; sqlite3 reuses the prepared statement for every batch
+        self._insert_stmt = """
+        INSERT OR REPLACE INTO pdf_info (path, dir, title, authors, size, mtime)
+        VALUES (?, ?, ?, ?, ?, ?)
+        """
+        self.concurrency = concurrency
         print(f"Searching {DIRECTORY} using model {OLLAMA_MODEL} on Ollama server at {OLLAMA_URL}")
-        print(f"Timeout set to {OLLAMA_TIMEOUT} seconds")
+        print(f"Timeout set to {OLLAMA_TIMEOUT} seconds, processing {concurrency} papers at a time")
 
     def __del__(self):
         self.connection.close()
 
-    def find_paper(self, path: str) -> Paper:
-        text = extract_text(path, maxpages=1)
+    @staticmethod
+    def _connect(**kwargs) -> sqlite3.Connection:
+        """Open the database in autocommit mode; transactions are begun explicitly."""
+        connection = sqlite3.connect('../pdf_files.db', isolation_level=None, **kwargs)
+        connection.executescript(SQLITE_PRAGMAS)
+        return connection
+
+    async def find_paper(self, path: str, client: AsyncClient, executor: Executor | None = None) -> Paper:
+        # Parsing is CPU-bound, so do it in the executor while other chats are in flight.
+        # pdfium isn't thread-safe, so without a (process) executor parse inline.
+        if executor is None:
+            text = first_page_text(path)
+        else:
+            text = await asyncio.get_running_loop().run_in_executor(executor, first_page_text, path)
+        # Title and authors are at the top of the page; the model doesn't need the rest
+        lines = [line for line in text.splitlines() if line.strip()]
+        text = '\n'.join(lines[:MAX_TEXT_LINES])[:MAX_TEXT_LENGTH]
         messages = [{
             "role": "user",
             "content": TEMPLATE.format(text=text)
         }]
         
         try:
-            response = self.client.chat(
+            response = await client.chat(
                 model=OLLAMA_MODEL, 
                 messages=messages, 
-                format=PAPER_FORMAT
+                format=PAPER_FORMAT,
+                options=OLLAMA_OPTIONS
             )
+            if response.done_reason == "length":
+                # The JSON would be cut off mid-object, so say why instead of failing validation
+                raise Exception(f"Ollama's reply hit the {OLLAMA_NUM_PREDICT} token limit; "
+                                f"raise OLLAMA_NUM_PREDICT")
             return Paper.model_validate_json(response.message.content)
         except Exception as e:
             if "timeout" in str(e).lower():
                 raise Exception(f"Ollama request timed out after {OLLAMA_TIMEOUT} seconds") from e
             raise
 
-    def update_paper(self, path: str):
-        sql = """
-        INSERT OR REPLACE INTO pdf_info (path, title, authors)
-        VALUES (?, ?, ?)
+    async def update_paper(self, path: str, client: AsyncClient, semaphore: asyncio.Semaphore,
+                           executor: Executor | None = None) -> tuple | None:
+        """Find the title and authors of a paper, returning the row to store or None if there is nothing to store."""
+        try:
+            st = os.stat(path)
+            if self._is_unchanged(path, st):
+                return None
+            async with semaphore:
+                paper = await self.find_paper(path, client, executor)
+            params = (path, os.path.dirname(path), paper.title, ', '.join(paper.authors))
+            logger.info("%s", params)
+            return params + (st.st_size, st.st_mtime)
+        except Exception as e:
+            logger.warning("Cannot update %s: %s", path, e)
+            return None
 
-        """
+    def _is_unchanged(self, path: str, st: os.stat_result) -> bool:
+        """Return True if the file is already stored with the same size and modification time."""
+        row = self.connection.execute("SELECT size, mtime FROM pdf_info WHERE path = ?", (path,)).fetchone()
+        return row == (st.st_size, st.st_mtime)
+
+    def save_papers(self, rows: list[tuple], connection: sqlite3.Connection | None = None):
+        """Store a batch of rows in a single transaction, on the Librarian's connection unless given another."""
+        connection = connection or self.connection
+        with connection:
+            connection.execute("BEGIN")
+            connection.executemany(self._insert_stmt, rows)
+
+    def _write_papers(self, rows: queue.Queue, connection: sqlite3.Connection):
+        """Save rows from the queue, BATCH_SIZE at a time, until None arrives, then close the connection."""
+        batch = []
+        try:
+            while (row := rows.get()) is not None:
+                batch.append(row)
+                if len(batch) >= BATCH_SIZE:
+                    self._save_batch(batch, connection)
+                    batch = []
+            if batch:
+                self._save_batch(batch, connection)
+        finally:
+            connection.close()
 
+    def _save_batch(self, rows: list[tuple], connection: sqlite3.Connection):
+        """Save a batch, reporting each paper in a failed batch rather than raising, so writing carries on."""
         try:
-            paper = self.find_paper(path)
-            cursor = self.connection.cursor()
-            params = (path, paper.title, ', '.join(paper.authors))
-            print(params)
-            cursor.execute(sql, params)
-            self.connection.commit()
+            self.save_papers(rows, connection)
         except Exception as e:
-            print(f"Cannot update {path}: {e}")
+            for row in rows:
+                logger.warning("Cannot update %s: %s", row[0], e)
 
     def _create_table(self):
-        """Create the pdf_info table if it does not exist."""
+        """Create the pdf_info table if it does not exist, upgrading tables from older versions."""
         create_table_query = """
         CREATE TABLE IF NOT EXISTS pdf_info (
             path TEXT PRIMARY KEY,
+            dir TEXT,
             title TEXT,
-            authors TEXT
+            authors TEXT,
+            size INTEGER,
+            mtime REAL
         );
         """
-        cursor = self.connection.cursor()
-        cursor.execute(create_table_query)
-        self.connection.commit()
+        with self.connection:
+            self.connection.execute("BEGIN")
+            self.connection.execute(create_table_query)
+            columns = {row[1] for row in self.connection.execute("PRAGMA table_info(pdf_info)")}
+            if 'dir' not in columns:
+                # dir lets generate-index-files.py fetch just one directory's papers
+                self.connection.execute("ALTER TABLE pdf_info ADD COLUMN dir TEXT")
+                paths = self.connection.execute("SELECT path FROM pdf_info").fetchall()
+                self.connection.executemany("UPDATE pdf_info SET dir = ? WHERE path = ?",
+                                            [(os.path.dirname(path), path) for path, in paths])
+            if 'size' not in columns:
+                # size and mtime let later runs skip files that haven't changed.
+                # Trust existing rows and record the files as they are now.
+                self.connection.execute("ALTER TABLE pdf_info ADD COLUMN size INTEGER")
+                self.connection.execute("ALTER TABLE pdf_info ADD COLUMN mtime REAL")
+                stats = []
+                for path, in self.connection.execute("SELECT path FROM pdf_info").fetchall():
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    stats.append((st.st_size, st.st_mtime, path))
+                self.connection.executemany("UPDATE pdf_info SET size = ?, mtime = ? WHERE path = ?", stats)
+            self.connection.execute("CREATE INDEX IF NOT EXISTS idx_pdf_info_dir ON pdf_info (dir)")
 
 
+    async def process_files_async(self, *file_list: str):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        # A client per run: its pooled connections belong to this run's event loop.
+        # The transport keeps a connection alive per paper in flight, and closing it
+        # closes them (the ollama client has no close method of its own).
+        transport = httpx.AsyncHTTPTransport(
+            limits=httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency)
+        )
+        client = AsyncClient(host=OLLAMA_URL, timeout=OLLAMA_TIMEOUT, transport=transport)
+        # Hand rows to a single writer thread, so commits never stall the event loop.
+        # It has its own connection (WAL lets _is_unchanged read alongside it); it is
+        # opened here so that failing to open it stops the run straight away.
+        rows = queue.Queue()
+        self.connection.executescript(RUN_PRAGMAS)
+        writer_connection = self._connect(check_same_thread=False)
+        writer_connection.executescript(RUN_PRAGMAS)
+        writer = threading.Thread(target=self._write_papers, args=(rows, writer_connection))
+        writer.start()
+        try:
+            with ProcessPoolExecutor() as executor:
+                tasks = [self.update_paper(path.strip(), client, semaphore, executor) for path in file_list]
+                for task in asyncio.as_completed(tasks):
+                    row = await task
+                    if row is not None:
+                        rows.put(row)
+        finally:
+            rows.put(None)
+            writer.join()
+            await transport.aclose()
+            self._leave_wal()
+
+    def _leave_wal(self):
+        """Checkpoint the WAL into the database and switch it back to a rollback journal."""
+        try:
+            mode = self.connection.execute("PRAGMA journal_mode=DELETE").fetchone()[0]
+            reason = f"journal mode is still {mode}"
+        except sqlite3.OperationalError as e:
+            # Another connection (say, the index generator) still has the database open
+            mode, reason = None, str(e)
+        if mode != 'delete':
+            logger.warning("Could not switch the database out of WAL mode (%s); "
+                           "reading it will need write access to its directory", reason)
+        self.connection.execute("PRAGMA synchronous=FULL")
+
     def process_files(self, *file_list: str):
-        for path in file_list:
-            self.update_paper(path.strip())
+        asyncio.run(self.process_files_async(*file_list))
 
-import os
+
+PDF_SUFFIXES = ('.pdf', '.PDF', '.Pdf')
+
+
+def is_pdf_name(name: str) -> bool:
+    """Return True if name has a .pdf extension, in any case, trying the usual spellings first."""
+    return name.endswith(PDF_SUFFIXES) or name[-4:].lower() == '.pdf'
+
+
+def _pdf_paths(directory: str):
+    # os.scandir hands back each entry's type with the listing, so nothing is stat'ed twice
+    try:
+        entries = os.scandir(directory)
+    except OSError:
+        return  # unreadable directories are skipped, as os.walk does
+    with entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from _pdf_paths(entry.path)
+            # Only regular files (or links to them), so a directory named x.pdf is never a PDF
+            elif entry.is_file() and is_pdf_name(entry.name):
+                yield entry.path
 
 
 def pdfs_in(directory: str):
-    pdf_files = []
-    # Walk through the given directory and subdirectories
-    for root, _, files in os.walk(directory):
-        for file in files:
-            # Check if file has a .pdf extension (case-insensitive)
-            if file.lower().endswith('.pdf'):
-                # Add the absolute path of the PDF to the list
-                pdf_files.append(os.path.abspath(os.path.join(root, file)))
-    return pdf_files
+    # Walk through the given directory and subdirectories, collecting absolute paths of PDFs
+    return list(_pdf_paths(os.path.abspath(directory)))
 
 
 if __name__ == '__main__':
+    # Buffer the per-paper lines and write them 100 at a time, not one flush per paper.
+    # Only our own logger reports INFO; httpx would log every request.
+    log_buffer = logging.handlers.MemoryHandler(100, target=logging.StreamHandler(sys.stdout))
+    logging.basicConfig(handlers=[log_buffer])
+    logger.setLevel(logging.INFO)
     start_time = time.time()
     # files = pdfs_in('../../data/pdfs')
     files = pdfs_in(DIRECTORY)
     print(len(files))
     library = Librarian()
     library.process_files(*files)
+    log_buffer.flush()
     end_time = time.time()
     print(f"\nTime taken: {end_time - start_time:.2f} seconds")